@@ -5,6 +5,7 @@
 
 from collections import namedtuple
 from enum import Enum
+from functools import partial
 import numpy as np
 
 from datumaro.util.image import Image
@@ -241,8 +242,12 @@ class RleMask(Mask):
 
     @staticmethod
     def _lazy_decode(rle):
+        return partial(RleMask._decode, rle) # picklable, unlike a lambda
+
+    @staticmethod
+    def _decode(rle):
         from pycocotools import mask as mask_utils
-        return lambda: mask_utils.decode(rle).astype(np.bool)
+        return mask_utils.decode(rle).astype(np.bool)
 
     def get_area(self):
         from pycocotools import mask as mask_utils
@@ -325,7 +330,7 @@ class CompiledMask:
         return self.instance_mask == instance_id
 
     def lazy_extract(self, instance_id):
-        return lambda: self.extract(instance_id)
+        return partial(self.extract, instance_id)
 
 def compute_iou(bbox_a, bbox_b):
     aX, aY, aW, aH = bbox_a
@@ -5,10 +5,15 @@
 
 import codecs
 from collections import OrderedDict
+from functools import lru_cache
 import logging as log
+from multiprocessing import Pool
+import numpy as np
 import os
 import os.path as osp
+from queue import Queue
 import string
+from threading import Thread
 
 from datumaro.components.extractor import (AnnotationType, DEFAULT_SUBSET_NAME,
     LabelCategories
@@ -17,33 +22,92 @@ from datumaro.components.converter import Converter
 from datumaro.components.cli_plugin import CliPlugin
 from datumaro.util.image import encode_image
 from datumaro.util.mask_tools import merge_masks
-from datumaro.util.annotation_tools import (compute_bbox,
-    find_group_leader, find_instances)
 from datumaro.util.tf_util import import_tf as _import_tf
 
 from .format import DetectionApiPath
 tf = _import_tf()
 
 
+_IMAGE_EXT = DetectionApiPath.IMAGE_EXT.encode('utf-8')
+_IMAGE_FORMAT = DetectionApiPath.IMAGE_FORMAT.encode('utf-8')
+
 # filter out non-ASCII characters, otherwise training will crash
-_printable = set(string.printable)
+_non_printable = bytes(i for i in range(128)
+    if chr(i) not in string.printable)
 def _make_printable(s):
-    return ''.join(filter(lambda x: x in _printable, s))
+    return s.encode('ascii', 'ignore').translate(None, _non_printable)
+
+# Records are encoded directly in the protobuf wire format to avoid
+# building intermediate tf.train.* objects for each feature.
+# https://developers.google.com/protocol-buffers/docs/encoding
+_WIRE_BYTES = 2
+
+def _encode_varint(value):
+    value = int(value) & 0xFFFFFFFFFFFFFFFF # negative values are 10 bytes long
+    result = bytearray()
+    while 0x7F < value:
+        result.append(0x80 | (value & 0x7F))
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+def _encode_tag(field_number, wire_type):
+    return _encode_varint((field_number << 3) | wire_type)
+
+def _encode_bytes(field_number, value):
+    return _encode_tag(field_number, _WIRE_BYTES) + \
+        _encode_varint(len(value)) + value
+
+def _encode_packed(field_number, value):
+    if not value:
+        return b''
+    return _encode_bytes(field_number, value)
+
+# Field numbers of the tf.train.Feature "kind" variants
+_FEATURE_BYTES_LIST = 1
+_FEATURE_FLOAT_LIST = 2
+_FEATURE_INT64_LIST = 3
 
 def int64_feature(value):
-    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+    return int64_list_feature([value])
 
 def int64_list_feature(value):
-    return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
+    if value and 0 <= min(value) and max(value) <= 0x7F:
+        values = bytes(value) # small values are single-byte varints
+    else:
+        values = b''.join(_encode_varint(v) for v in value)
+    return _encode_bytes(_FEATURE_INT64_LIST, _encode_packed(1, values))
 
 def bytes_feature(value):
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+    return bytes_list_feature([value])
 
 def bytes_list_feature(value):
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=value))
+    values = b''.join(_encode_bytes(1, v) for v in value)
+    return _encode_bytes(_FEATURE_BYTES_LIST, values)
 
 def float_list_feature(value):
-    return tf.train.Feature(float_list=tf.train.FloatList(value=value))
+    values = np.asarray(value, dtype='<f4').tobytes()
+    return _encode_bytes(_FEATURE_FLOAT_LIST, _encode_packed(1, values))
+
+# The same features are written for each record
+_EMPTY_BYTES_FEATURE = bytes_feature(b'')
+_IMAGE_FORMAT_FEATURE = bytes_feature(_IMAGE_FORMAT)
+
+@lru_cache(maxsize=None)
+def _encode_feature_key(key):
+    return _encode_bytes(1, key.encode('utf-8'))
+
+def make_tf_example(features):
+    """
+    Returns a serialized tf.train.Example with the provided
+    encoded features.
+    """
+
+    entries = b''.join(
+        _encode_bytes(1, _encode_feature_key(key) + _encode_bytes(2, feature))
+        for key, feature in features.items()
+    )
+    return _encode_bytes(1, entries)
 
 class TfDetectionApiConverter(Converter, CliPlugin):
     @classmethod
@@ -53,101 +117,212 @@ class TfDetectionApiConverter(Converter, CliPlugin):
             help="Save images (default: %(default)s)")
         parser.add_argument('--save-masks', action='store_true',
             help="Include instance masks (default: %(default)s)")
+        parser.add_argument('--compress', action='store_true',
+            help="Compress records with GZIP (default: %(default)s)")
+        parser.add_argument('--num-workers', type=int, default=0,
+            help="Number of worker processes to build records in, "
+                "0 to build them in the main process (default: %(default)s)")
         return parser
 
-    def __init__(self, save_images=False, save_masks=False):
+    def __init__(self, save_images=False, save_masks=False, compress=False,
+            num_workers=0):
         super().__init__()
 
         self._save_images = save_images
         self._save_masks = save_masks
+        self._compress = compress
+        self._num_workers = num_workers
 
     def __call__(self, extractor, save_dir):
         os.makedirs(save_dir, exist_ok=True)
 
         label_categories = extractor.categories().get(AnnotationType.label,
             LabelCategories())
-        get_label = lambda label_id: label_categories.items[label_id].name \
-            if label_id is not None else ''
         label_ids = OrderedDict((label.name, 1 + idx)
             for idx, label in enumerate(label_categories.items))
-        map_label_id = lambda label_id: label_ids.get(get_label(label_id), 0)
-        self._get_label = get_label
-        self._get_label_id = map_label_id
+        # keep only picklable state, the converter is sent to workers
+        self._label_names = [label.name for label in label_categories.items]
+        self._label_ids = label_ids
+        self._label_cache = { label_id: (
+                _make_printable(self._get_label(label_id)),
+                self._get_label_id(label_id)
+            ) for label_id in [None] + list(range(len(self._label_names)))
+        }
+
+        labelmap_path = osp.join(save_dir, DetectionApiPath.LABELMAP_FILE)
+        with codecs.open(labelmap_path, 'w', encoding='utf8') as f:
+            f.write(''.join(
+                'item {\n' +
+                ('\tid: %s\n' % (idx)) +
+                ("\tname: '%s'\n" % (label)) +
+                '}\n\n'
+                for label, idx in label_ids.items()
+            ))
+
+        options = None
+        if self._compress:
+            # records are large and mostly binary, prefer speed
+            options = tf.io.TFRecordOptions(compression_type='GZIP',
+                compression_level=1)
 
         subsets = extractor.subsets()
         if len(subsets) == 0:
             subsets = [ None ]
 
-        for subset_name in subsets:
-            if subset_name:
-                subset = extractor.get_subset(subset_name)
-            else:
-                subset_name = DEFAULT_SUBSET_NAME
-                subset = extractor
-
-            labelmap_path = osp.join(save_dir, DetectionApiPath.LABELMAP_FILE)
-            with codecs.open(labelmap_path, 'w', encoding='utf8') as f:
-                for label, idx in label_ids.items():
-                    f.write(
-                        'item {\n' +
-                        ('\tid: %s\n' % (idx)) +
-                        ("\tname: '%s'\n" % (label)) +
-                        '}\n\n'
-                    )
-
-            anno_path = osp.join(save_dir, '%s.tfrecord' % (subset_name))
-            with tf.io.TFRecordWriter(anno_path) as writer:
-                for item in subset:
-                    tf_example = self._make_tf_example(item)
-                    writer.write(tf_example.SerializeToString())
+        # Protobuf serialization and image encoding are CPU-bound,
+        # so records can be built in separate processes. The pool is
+        # created before the writer threads are started, because forking
+        # a process with running threads can deadlock.
+        pool = None
+        if 0 < self._num_workers:
+            pool = Pool(self._num_workers)
+
+        try:
+            for subset_name in subsets:
+                if subset_name:
+                    subset = extractor.get_subset(subset_name)
+                else:
+                    subset_name = DEFAULT_SUBSET_NAME
+                    subset = extractor
+
+                anno_path = osp.join(save_dir, '%s.tfrecord' % (subset_name))
+                with tf.io.TFRecordWriter(anno_path,
+                        options=options) as writer:
+                    self._write_records(writer,
+                        self._make_tf_records(subset, pool))
+        finally:
+            if pool is not None:
+                pool.terminate()
 
     @staticmethod
-    def _find_instances(annotations):
-        return find_instances(a for a in annotations
-            if a.type in { AnnotationType.bbox, AnnotationType.mask })
-
-    def _find_instance_parts(self, group, img_width, img_height):
-        boxes = [a for a in group if a.type == AnnotationType.bbox]
-        masks = [a for a in group if a.type == AnnotationType.mask]
-
-        anns = boxes + masks
-        leader = find_group_leader(anns)
-        bbox = compute_bbox(anns)
-
-        mask = None
-        if self._save_masks:
-            mask = merge_masks([m.image for m in masks])
-
-        return [leader, mask, bbox]
+    def _write_records(writer, records):
+        # TFRecordWriter releases the GIL while writing, so records are
+        # written in a separate thread, while the next ones are being built
+        queue = Queue(maxsize=64)
+        errors = []
+        def _write():
+            for record in iter(queue.get, None):
+                if errors:
+                    continue # keep consuming to not block the producer
+                try:
+                    writer.write(record)
+                except Exception as e:
+                    errors.append(e)
+
+        thread = Thread(target=_write)
+        thread.start()
+        try:
+            for record in records:
+                queue.put(record)
+                if errors:
+                    break
+        finally:
+            queue.put(None)
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def _make_tf_records(self, items, pool=None):
+        if pool is None:
+            for item in items:
+                yield self._make_tf_example(item)
+            return
+
+        # the order of the items is kept
+        yield from pool.imap(self._make_tf_example, items, chunksize=16)
+
+    def _get_label(self, label_id):
+        if label_id is None:
+            return ''
+        return self._label_names[label_id]
+
+    def _get_label_id(self, label_id):
+        return self._label_ids.get(self._get_label(label_id), 0)
+
+    def _find_instances(self, annotations):
+        """
+        Collects bboxes and masks into instances in a single pass.
+        Returns a [leader, mask, bbox] list for each instance.
+        """
+
+        instances = [] # (group id, instance) pairs
+        groups = {}
+        for ann in annotations:
+            is_box = ann.type == AnnotationType.bbox
+            if not is_box and ann.type != AnnotationType.mask:
+                continue
+
+            instance = None
+            if ann.group:
+                instance = groups.get(ann.group)
+            if instance is None:
+                instance = { 'leader': None, 'area': -1, 'is_box': False,
+                    'x0': float('inf'), 'y0': float('inf'),
+                    'x1': float('-inf'), 'y1': float('-inf'),
+                    'masks': [] }
+                instances.append((ann.group or 0, instance))
+                if ann.group:
+                    groups[ann.group] = instance
+
+            x, y, w, h = ann.get_bbox()
+
+            # boxes are preferred to masks of the same area
+            if is_box:
+                area = w * h # the same as get_area()
+            else:
+                area = ann.get_area()
+            if instance['area'] < area or \
+                    area == instance['area'] and is_box and \
+                        not instance['is_box']:
+                instance.update(leader=ann, area=area, is_box=is_box)
+
+            instance['x0'] = min(instance['x0'], x)
+            instance['y0'] = min(instance['y0'], y)
+            instance['x1'] = max(instance['x1'], x + w)
+            instance['y1'] = max(instance['y1'], y + h)
+
+            if not is_box and self._save_masks:
+                instance['masks'].append(ann.image)
+
+        instances.sort(key=lambda e: e[0])
+
+        result = []
+        for _, instance in instances:
+            x0, y0 = instance['x0'], instance['y0']
+            bbox = [x0, y0, instance['x1'] - x0, instance['y1'] - y0]
+            result.append([instance['leader'],
+                merge_masks(instance['masks']), bbox])
+        return result
 
     def _export_instances(self, instances, width, height):
-        xmins = [] # List of normalized left x coordinates of bounding boxes (1 per box)
-        xmaxs = [] # List of normalized right x coordinates of bounding boxes (1 per box)
-        ymins = [] # List of normalized top y coordinates of bounding boxes (1 per box)
-        ymaxs = [] # List of normalized bottom y coordinates of bounding boxes (1 per box)
         classes_text = [] # List of class names of bounding boxes (1 per box)
         classes = [] # List of class ids of bounding boxes (1 per box)
         masks = [] # List of PNG-encoded instance masks (1 per box)
 
-        for leader, mask, box in instances:
-            label = _make_printable(self._get_label(leader.label))
-            classes_text.append(label.encode('utf-8'))
-            classes.append(self._get_label_id(leader.label))
-
-            xmins.append(box[0] / width)
-            xmaxs.append((box[0] + box[2]) / width)
-            ymins.append(box[1] / height)
-            ymaxs.append((box[1] + box[3]) / height)
+        for leader, mask, _ in instances:
+            label_text, label_id = self._label_cache[leader.label]
+            classes_text.append(label_text)
+            classes.append(label_id)
 
             if self._save_masks:
                 if mask is not None:
-                    mask = encode_image(mask, '.png')
+                    # masks compress well at any level, prefer speed
+                    mask = encode_image(mask, '.png',
+                        png_compression=1, png_bilevel=True)
                 else:
                     mask = b''
                 masks.append(mask)
 
         result = {}
         if classes:
+            # Normalized coordinates of bounding boxes (1 row per box)
+            boxes = np.array([box for _, _, box in instances], dtype=float)
+            xmins = boxes[:, 0] / width
+            xmaxs = (boxes[:, 0] + boxes[:, 2]) / width
+            ymins = boxes[:, 1] / height
+            ymaxs = (boxes[:, 1] + boxes[:, 3]) / height
+
             result = {
                 'image/object/bbox/xmin': float_list_feature(xmins),
                 'image/object/bbox/xmax': float_list_feature(xmaxs),
@@ -167,40 +342,46 @@ class TfDetectionApiConverter(Converter, CliPlugin):
             ),
         }
 
-        filename = item.id + DetectionApiPath.IMAGE_EXT
-        features['image/filename'] = bytes_feature(filename.encode('utf-8'))
+        filename = item.id.encode('utf-8') + _IMAGE_EXT
+        features['image/filename'] = bytes_feature(filename)
 
         if not item.has_image:
             raise Exception("Failed to export dataset item '%s': "
                 "item has no image info" % item.id)
-        height, width = item.image.size
+
+        # the image can be loaded from disk on each access, so do it once
+        image = item.image
+        data = None
+        if self._save_images:
+            if image.has_data:
+                data = image.data
+            else:
+                log.warning("Item '%s' has no image" % item.id)
+
+        if data is not None:
+            height, width = data.shape[:2]
+        else:
+            height, width = image.size
 
         features.update({
             'image/height': int64_feature(height),
             'image/width': int64_feature(width),
         })
 
-        features.update({
-            'image/encoded': bytes_feature(b''),
-            'image/format': bytes_feature(b'')
-        })
-        if self._save_images:
-            if item.has_image and item.image.has_data:
-                fmt = DetectionApiPath.IMAGE_FORMAT
-                buffer = encode_image(item.image.data, DetectionApiPath.IMAGE_EXT)
-
-                features.update({
-                    'image/encoded': bytes_feature(buffer),
-                    'image/format': bytes_feature(fmt.encode('utf-8')),
-                })
-            else:
-                log.warning("Item '%s' has no image" % item.id)
+        if data is not None:
+            buffer = encode_image(data, DetectionApiPath.IMAGE_EXT)
+
+            features.update({
+                'image/encoded': bytes_feature(buffer),
+                'image/format': _IMAGE_FORMAT_FEATURE,
+            })
+        else:
+            features.update({
+                'image/encoded': _EMPTY_BYTES_FEATURE,
+                'image/format': _EMPTY_BYTES_FEATURE,
+            })
 
         instances = self._find_instances(item.annotations)
-        instances = [self._find_instance_parts(i, width, height) for i in instances]
         features.update(self._export_instances(instances, width, height))
 
-        tf_example = tf.train.Example(
-            features=tf.train.Features(feature=features))
-
-        return tf_example
+        return make_tf_example(features)
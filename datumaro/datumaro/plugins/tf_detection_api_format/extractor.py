@@ -21,6 +21,10 @@ tf = _import_tf()
 def clamp(value, _min, _max):
     return max(min(_max, value), _min)
 
+def _decode_mask(buffer):
+    # instance masks are binary, saved with 0 and 1 or with 0 and 255
+    return decode_image(buffer) != 0
+
 class TfDetectionApiExtractor(SourceExtractor):
     def __init__(self, path):
         assert osp.isfile(path), path
@@ -75,9 +79,23 @@ class TfDetectionApiExtractor(SourceExtractor):
 
         return labelmap
 
+    @staticmethod
+    def _detect_compression(path):
+        for compression in ['', 'GZIP']:
+            try:
+                dataset = tf.data.TFRecordDataset(path,
+                    compression_type=compression)
+                for _ in dataset.take(1):
+                    pass
+                return compression
+            except tf.errors.DataLossError:
+                pass
+        return ''
+
     @classmethod
     def _parse_tfrecord_file(cls, filepath, subset, images_dir):
-        dataset = tf.data.TFRecordDataset(filepath)
+        dataset = tf.data.TFRecordDataset(filepath,
+            compression_type=cls._detect_compression(filepath))
         features = {
             'image/filename': tf.io.FixedLenFeature([], tf.string),
             'image/source_id': tf.io.FixedLenFeature([], tf.string),
@@ -95,6 +113,17 @@ class TfDetectionApiExtractor(SourceExtractor):
             'image/object/mask': tf.io.VarLenFeature(tf.string),
         }
 
+        def _parse_record(record):
+            # parse in the dataset pipeline instead of per-record eager calls
+            parsed_record = tf.io.parse_single_example(record, features)
+            for key, value in parsed_record.items():
+                if isinstance(value, tf.sparse.SparseTensor):
+                    default_value = b'' if value.dtype == tf.string else None
+                    parsed_record[key] = tf.sparse.to_dense(value,
+                        default_value=default_value)
+            return parsed_record
+        dataset = dataset.map(_parse_record)
+
         dataset_labels = OrderedDict()
         labelmap_path = osp.join(osp.dirname(filepath),
             DetectionApiPath.LABELMAP_FILE)
@@ -107,8 +136,7 @@ class TfDetectionApiExtractor(SourceExtractor):
 
         dataset_items = []
 
-        for record in dataset:
-            parsed_record = tf.io.parse_single_example(record, features)
+        for parsed_record in dataset:
             frame_id = parsed_record['image/source_id'].numpy().decode('utf-8')
             frame_filename = \
                 parsed_record['image/filename'].numpy().decode('utf-8')
@@ -118,22 +146,13 @@ class TfDetectionApiExtractor(SourceExtractor):
                 parsed_record['image/width'], tf.int64).numpy().item()
             frame_image = parsed_record['image/encoded'].numpy()
             frame_format = parsed_record['image/format'].numpy().decode('utf-8')
-            xmins = tf.sparse.to_dense(
-                parsed_record['image/object/bbox/xmin']).numpy()
-            ymins = tf.sparse.to_dense(
-                parsed_record['image/object/bbox/ymin']).numpy()
-            xmaxs = tf.sparse.to_dense(
-                parsed_record['image/object/bbox/xmax']).numpy()
-            ymaxs = tf.sparse.to_dense(
-                parsed_record['image/object/bbox/ymax']).numpy()
-            label_ids = tf.sparse.to_dense(
-                parsed_record['image/object/class/label']).numpy()
-            labels = tf.sparse.to_dense(
-                parsed_record['image/object/class/text'],
-                default_value=b'').numpy()
-            masks = tf.sparse.to_dense(
-                parsed_record['image/object/mask'],
-                default_value=b'').numpy()
+            xmins = parsed_record['image/object/bbox/xmin'].numpy()
+            ymins = parsed_record['image/object/bbox/ymin'].numpy()
+            xmaxs = parsed_record['image/object/bbox/xmax'].numpy()
+            ymaxs = parsed_record['image/object/bbox/ymax'].numpy()
+            label_ids = parsed_record['image/object/class/label'].numpy()
+            labels = parsed_record['image/object/class/text'].numpy()
+            masks = parsed_record['image/object/mask'].numpy()
 
             for label, label_id in zip(labels, label_ids):
                 label = label.decode('utf-8')
@@ -158,7 +177,7 @@ class TfDetectionApiExtractor(SourceExtractor):
 
                 if mask is not None:
                     if isinstance(mask, bytes):
-                        mask = lazy_image(mask, decode_image)
+                        mask = lazy_image(mask, _decode_mask)
                     annotations.append(Mask(image=mask,
                         label=dataset_labels.get(label)
                     ))
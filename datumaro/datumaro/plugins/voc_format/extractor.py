@@ -4,6 +4,7 @@
 # SPDX-License-Identifier: MIT
 
 from collections import defaultdict
+from functools import partial
 import logging as log
 import numpy as np
 import os.path as osp
@@ -247,7 +248,7 @@ class VocSegmentationExtractor(_VocExtractor):
 
     @staticmethod
     def _lazy_extract_mask(mask, c):
-        return lambda: mask == c
+        return partial(np.equal, mask, c)
 
     def _load_annotations(self, item_id):
         item_annotations = []
@@ -3,31 +3,48 @@
 #
 # SPDX-License-Identifier: MIT
 
-from itertools import groupby
-
 import numpy as np
 
 
 def find_instances(instance_anns):
-    instance_anns = sorted(instance_anns, key=lambda a: a.group)
-    ann_groups = []
-    for g_id, group in groupby(instance_anns, lambda a: a.group):
-        if not g_id:
-            ann_groups.extend(([a] for a in group))
+    ann_groups = [] # (group id, annotations) pairs
+    groups = {}
+    for ann in instance_anns:
+        if not ann.group:
+            ann_groups.append((0, [ann]))
+        elif ann.group in groups:
+            groups[ann.group].append(ann)
         else:
-            ann_groups.append(list(group))
+            group = [ann]
+            groups[ann.group] = group
+            ann_groups.append((ann.group, group))
 
-    return ann_groups
+    # the sort is stable, so ungrouped annotations keep their order
+    ann_groups.sort(key=lambda g: g[0])
+    return [group for _, group in ann_groups]
 
 def find_group_leader(group):
     return max(group, key=lambda x: x.get_area())
 
 def compute_bbox(annotations):
-    boxes = [ann.get_bbox() for ann in annotations]
-    x0 = min((b[0] for b in boxes), default=0)
-    y0 = min((b[1] for b in boxes), default=0)
-    x1 = max((b[0] + b[2] for b in boxes), default=0)
-    y1 = max((b[1] + b[3] for b in boxes), default=0)
+    x0 = y0 = x1 = y1 = None
+    for ann in annotations:
+        x, y, w, h = ann.get_bbox()
+        if x0 is None:
+            x0, y0, x1, y1 = x, y, x + w, y + h
+            continue
+
+        if x < x0:
+            x0 = x
+        if y < y0:
+            y0 = y
+        if x1 < x + w:
+            x1 = x + w
+        if y1 < y + h:
+            y1 = y + h
+
+    if x0 is None:
+        return [0, 0, 0, 0]
     return [x0, y0, x1 - x0, y1 - y0]
 
 def softmax(x):
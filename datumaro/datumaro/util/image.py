@@ -104,8 +104,18 @@ def encode_image(image, ext, **kwargs):
             params = [
                 int(cv2.IMWRITE_JPEG_QUALITY), kwargs.get('jpeg_quality', 75)
             ]
-
-        image = image.astype(np.uint8)
+        elif ext.upper() == '.PNG':
+            if kwargs.get('png_compression') is not None:
+                params += [
+                    int(cv2.IMWRITE_PNG_COMPRESSION), kwargs['png_compression']
+                ]
+            if kwargs.get('png_bilevel'):
+                params += [int(cv2.IMWRITE_PNG_BILEVEL), 1]
+
+        if kwargs.get('png_bilevel'):
+            image = (image != 0).astype(np.uint8) # handles float masks too
+        else:
+            image = image.astype(np.uint8)
         success, result = cv2.imencode(ext, image, params=params)
         if not success:
             raise Exception("Failed to encode image to '%s' format" % (ext))
@@ -120,11 +130,16 @@ def encode_image(image, ext, **kwargs):
         params['quality'] = kwargs.get('jpeg_quality')
         if kwargs.get('jpeg_quality') == 100:
             params['subsampling'] = 0
-
-        image = image.astype(np.uint8)
-        if len(image.shape) == 3 and image.shape[2] in {3, 4}:
-            image[:, :, :3] = image[:, :, 2::-1] # BGR to RGB
-        image = Image.fromarray(image)
+        if kwargs.get('png_compression') is not None:
+            params['compress_level'] = kwargs['png_compression']
+
+        if kwargs.get('png_bilevel'):
+            image = Image.fromarray(image != 0)
+        else:
+            image = image.astype(np.uint8)
+            if len(image.shape) == 3 and image.shape[2] in {3, 4}:
+                image[:, :, :3] = image[:, :, 2::-1] # BGR to RGB
+            image = Image.fromarray(image)
         with BytesIO() as buffer:
             image.save(buffer, format=ext, **params)
             return buffer.getvalue()
@@ -3,6 +3,7 @@
 #
 # SPDX-License-Identifier: MIT
 
+from functools import partial
 import numpy as np
 
 from datumaro.util.image import lazy_image, load_image
@@ -114,7 +115,8 @@ def load_mask(path, inverse_colormap=None):
     return mask
 
 def lazy_mask(path, inverse_colormap=None):
-    return lazy_image(path, lambda path: load_mask(path, inverse_colormap))
+    return lazy_image(path,
+        partial(load_mask, inverse_colormap=inverse_colormap))
 
 def mask_to_rle(binary_mask):
     # walk in row-major order as COCO format specifies
@@ -281,9 +283,12 @@ def merge_masks(masks):
     """
     if not masks:
         return None
+    if len(masks) == 1:
+        return masks[0]
 
-    merged_mask = masks[0]
+    # update a single buffer in-place instead of allocating one per mask
+    merged_mask = np.array(masks[0], dtype=np.result_type(*masks))
     for m in masks[1:]:
-        merged_mask = np.where(m != 0, m, merged_mask)
+        np.copyto(merged_mask, m, where=(m != 0))
 
     return merged_mask
\ No newline at end of file
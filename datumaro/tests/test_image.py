@@ -52,6 +52,32 @@ class ImageOperationsTest(TestCase):
             self.assertTrue(np.array_equal(src_image, dst_image),
                 'save: %s, load: %s' % (save_backend, load_backend))
 
+    def test_can_encode_png_with_compression_level(self):
+        src_image = np.random.randint(0, 255 + 1, (2, 4, 3))
+        for backend in image_module._IMAGE_BACKENDS:
+            image_module._IMAGE_BACKEND = backend
+            buffer = image_module.encode_image(src_image, '.png',
+                png_compression=1)
+
+            dst_image = image_module.decode_image(buffer)
+
+            self.assertTrue(np.array_equal(src_image, dst_image),
+                'backend: %s' % backend)
+
+    def test_can_encode_bilevel_png(self):
+        src_image = np.array([[0, 1, 2], [255, 0, 3]])
+        for save_backend, load_backend in product(
+                image_module._IMAGE_BACKENDS, image_module._IMAGE_BACKENDS):
+            image_module._IMAGE_BACKEND = save_backend
+            buffer = image_module.encode_image(src_image, '.png',
+                png_bilevel=True)
+
+            image_module._IMAGE_BACKEND = load_backend
+            dst_image = image_module.decode_image(buffer)
+
+            self.assertTrue(np.array_equal(src_image != 0, dst_image != 0),
+                'save: %s, load: %s' % (save_backend, load_backend))
+
     def test_save_image_to_inexistent_dir_raises_error(self):
         with self.assertRaises(FileNotFoundError):
             image_module.save_image('some/path.jpg', np.ones((5, 4, 3)),
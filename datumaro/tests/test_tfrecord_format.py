@@ -4,10 +4,11 @@ import os.path as osp
 from unittest import TestCase, skipIf
 
 from datumaro.components.extractor import (Extractor, DatasetItem,
-    AnnotationType, Bbox, Mask, LabelCategories
+    AnnotationType, Bbox, Mask, RleMask, LabelCategories
 )
 from datumaro.components.project import Project
-from datumaro.util.image import Image
+from datumaro.util.image import Image, save_image
+from datumaro.util.mask_tools import lazy_mask
 from datumaro.util.test_utils import TestDir, compare_datasets
 from datumaro.util.tf_util import check_import
 
@@ -103,6 +104,74 @@ class TfrecordConverterTest(TestCase):
                 TestExtractor(), TfDetectionApiConverter(save_masks=True),
                 test_dir)
 
+    def test_can_save_grouped_instances(self):
+        mask_a = np.zeros((16, 16))
+        mask_a[5:7, 5:7] = 1 # the same area as the first box
+        mask_b = np.zeros((16, 16))
+        mask_b[10, 1:4] = 1
+        mask_c = np.zeros((16, 16))
+        mask_c[12:14, 12] = 1
+
+        class TestExtractor(Extractor):
+            def __iter__(self):
+                return iter([
+                    DatasetItem(id=1, subset='train',
+                        image=np.ones((16, 16, 3)),
+                        annotations=[
+                            Mask(image=mask_c, label=6, group=2),
+                            Bbox(0, 0, 2, 2, label=1, group=1),
+                            Mask(image=mask_a, label=2, group=1),
+                            Mask(image=mask_b, label=3, group=1),
+                            Bbox(8, 8, 1, 1, label=4, group=1),
+                        ],
+                        attributes={'source_id': ''}
+                    ),
+                ])
+
+            def categories(self):
+                label_cat = LabelCategories()
+                for label in range(10):
+                    label_cat.add('label_' + str(label))
+                return {
+                    AnnotationType.label: label_cat,
+                }
+
+        class DstBboxesExtractor(TestExtractor):
+            def __iter__(self):
+                return iter([
+                    DatasetItem(id=1, subset='train',
+                        image=np.ones((16, 16, 3)),
+                        annotations=[
+                            Bbox(0, 0, 9, 10, label=1),
+                            Bbox(12, 12, 0, 1, label=6),
+                        ],
+                        attributes={'source_id': ''}
+                    ),
+                ])
+
+        class DstMasksExtractor(TestExtractor):
+            def __iter__(self):
+                return iter([
+                    DatasetItem(id=1, subset='train',
+                        image=np.ones((16, 16, 3)),
+                        annotations=[
+                            Mask(image=mask_a + mask_b, label=1),
+                            Mask(image=mask_c, label=6),
+                        ],
+                        attributes={'source_id': ''}
+                    ),
+                ])
+
+        with TestDir() as test_dir:
+            self._test_save_and_load(TestExtractor(),
+                TfDetectionApiConverter(save_images=True), test_dir,
+                target_dataset=DstBboxesExtractor())
+
+        with TestDir() as test_dir:
+            self._test_save_and_load(TestExtractor(),
+                TfDetectionApiConverter(save_images=True, save_masks=True),
+                test_dir, target_dataset=DstMasksExtractor())
+
     def test_can_save_dataset_with_no_subsets(self):
         class TestExtractor(Extractor):
             def __iter__(self):
@@ -143,6 +212,96 @@ class TfrecordConverterTest(TestCase):
                 TestExtractor(), TfDetectionApiConverter(save_images=True),
                 test_dir)
 
+    def test_can_save_compressed(self):
+        class TestExtractor(Extractor):
+            def __iter__(self):
+                return iter([
+                    DatasetItem(id=1, subset='train',
+                        image=np.ones((16, 16, 3)),
+                        annotations=[
+                            Bbox(0, 4, 4, 8, label=2),
+                            Bbox(2, 4, 4, 4),
+                        ], attributes={'source_id': ''}
+                    ),
+                ])
+
+            def categories(self):
+                label_cat = LabelCategories()
+                for label in range(10):
+                    label_cat.add('label_' + str(label))
+                return {
+                    AnnotationType.label: label_cat,
+                }
+
+        with TestDir() as test_dir:
+            self._test_save_and_load(TestExtractor(),
+                TfDetectionApiConverter(save_images=True, compress=True),
+                test_dir)
+
+    def test_can_save_in_several_processes(self):
+        from pycocotools import mask as mask_utils
+
+        # items are sent to workers, so lazy loaders must be picklable
+        mask = np.array([
+            [0, 1, 1, 0],
+            [0, 1, 1, 0],
+            [0, 0, 0, 0],
+        ])
+
+        class TestExtractor(Extractor):
+            def __init__(self, image_path, mask_path):
+                super().__init__()
+                self._image_path = image_path
+                self._mask_path = mask_path
+
+            def __iter__(self):
+                return iter([
+                    DatasetItem(id=i, subset='train',
+                        image=Image(path=self._image_path),
+                        annotations=[
+                            RleMask(rle=mask_utils.encode(
+                                np.asfortranarray(mask.astype(np.uint8))),
+                                label=1),
+                            Mask(image=lazy_mask(self._mask_path), label=2),
+                        ],
+                        attributes={'source_id': ''}
+                    ) for i in range(20)
+                ])
+
+            def categories(self):
+                label_cat = LabelCategories()
+                for label in range(10):
+                    label_cat.add('label_' + str(label))
+                return {
+                    AnnotationType.label: label_cat,
+                }
+
+        class DstExtractor(TestExtractor):
+            def __iter__(self):
+                return iter([
+                    DatasetItem(id=i, subset='train',
+                        image=np.ones((3, 4, 3)),
+                        annotations=[
+                            Mask(image=mask, label=1),
+                            Mask(image=1 - mask, label=2),
+                        ],
+                        attributes={'source_id': ''}
+                    ) for i in range(20)
+                ])
+
+        with TestDir() as test_dir:
+            image_path = osp.join(test_dir, 'src', 'image.png')
+            save_image(image_path, np.ones((3, 4, 3)), create_dir=True)
+            mask_path = osp.join(test_dir, 'src', 'mask.png')
+            save_image(mask_path, 1 - mask)
+
+            self._test_save_and_load(
+                TestExtractor(image_path, mask_path),
+                TfDetectionApiConverter(save_images=True, save_masks=True,
+                    num_workers=2),
+                test_dir,
+                target_dataset=DstExtractor(image_path, mask_path))
+
     def test_can_save_dataset_with_image_info(self):
         class TestExtractor(Extractor):
             def __iter__(self):
@@ -160,6 +319,46 @@ class TfrecordConverterTest(TestCase):
             self._test_save_and_load(TestExtractor(),
                 TfDetectionApiConverter(), test_dir)
 
+    def test_can_encode_example(self):
+        from datumaro.plugins.tf_detection_api_format.converter import (
+            bytes_feature, bytes_list_feature, float_list_feature,
+            int64_feature, int64_list_feature, make_tf_example)
+        from datumaro.util.tf_util import import_tf
+        tf = import_tf()
+
+        expected = tf.train.Example(features=tf.train.Features(feature={
+            'a': tf.train.Feature(
+                int64_list=tf.train.Int64List(value=[0, 300, -2])),
+            'b': tf.train.Feature(int64_list=tf.train.Int64List(value=[])),
+            'c': tf.train.Feature(
+                float_list=tf.train.FloatList(value=[0.5, -1.25])),
+            'd': tf.train.Feature(
+                bytes_list=tf.train.BytesList(value=[b'', b'x' * 200])),
+            'e': tf.train.Feature(int64_list=tf.train.Int64List(value=[7])),
+            'g': tf.train.Feature(
+                int64_list=tf.train.Int64List(value=[0, 5, 127])),
+            'f': tf.train.Feature(bytes_list=tf.train.BytesList(value=[b'q'])),
+        }))
+
+        actual = tf.train.Example.FromString(make_tf_example({
+            'a': int64_list_feature([0, 300, -2]),
+            'b': int64_list_feature([]),
+            'c': float_list_feature([0.5, -1.25]),
+            'd': bytes_list_feature([b'', b'x' * 200]),
+            'e': int64_feature(7),
+            'g': int64_list_feature([0, 5, 127]),
+            'f': bytes_feature(b'q'),
+        }))
+
+        self.assertEqual(expected, actual)
+
+    def test_can_make_label_printable(self):
+        from datumaro.plugins.tf_detection_api_format.converter import \
+            _make_printable
+
+        self.assertEqual(b'label_1 a\tb',
+            _make_printable('label_\u04371\x00 a\tb\x7f\u00e9'))
+
     def test_labelmap_parsing(self):
         text = """
             {